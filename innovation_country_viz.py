@@ -4,19 +4,34 @@ Streamlit app for visualizing OpenAlex data on a treemap.
 Author: Shreyas Gadgin Matha
 """
 
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
+from pathlib import Path
+
+# Heavy libraries (plotly, google-cloud-storage, gcsfs) are imported
+# inside the functions that need them, so server start renders the UI
+# before paying their import cost
+import numpy as np
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.fs
+import pyarrow.parquet as pq
 import streamlit as st
+import google.auth.transport.requests
 from google.oauth2 import service_account
-from google.cloud import storage
-import gcsfs
 
 # Set app to be wide
 st.set_page_config(page_title="Country Innovation Profiles", layout="wide")
 
 
+@st.cache_resource
 def create_gcp_client():
+    from google.cloud import storage
+
     # Create GCP client
     credentials = service_account.Credentials.from_service_account_info(
         st.secrets["gcp_service_account"]
@@ -25,40 +40,507 @@ def create_gcp_client():
     return client
 
 
+@st.cache_resource
 def prepare_gcsfs():
+    import gcsfs
+
     # Get GCP client
     client = create_gcp_client()
-    # Create GCSFS
-    fs = gcsfs.GCSFileSystem(project=client.project, token=client._credentials)
+    # Create GCSFS. Large read-ahead blocks mean sequential consumers
+    # (the CSV fallback path) issue a few big GETs instead of many
+    # small ones, each of which pays full GCS latency
+    fs = gcsfs.GCSFileSystem(
+        project=client.project,
+        token=client._credentials,
+        default_block_size=64 * 1024 * 1024,
+        default_cache_type="readahead",
+    )
     return fs
 
 
-def gcsfs_to_pandas(fs, BUCKET_NAME, file_name):
+@st.cache_resource(ttl=600)
+def prepare_pyarrow_gcs():
+    # Create Arrow's native GCS filesystem from the same service account,
+    # so parquet range reads run concurrently in C++ instead of calling
+    # back into Python for every read
+    credentials = service_account.Credentials.from_service_account_info(
+        st.secrets["gcp_service_account"],
+        scopes=["https://www.googleapis.com/auth/devstorage.read_only"],
+    )
+    credentials.refresh(google.auth.transport.requests.Request())
+    return pyarrow.fs.GcsFileSystem(
+        access_token=credentials.token,
+        credential_token_expiration=credentials.expiry.replace(tzinfo=timezone.utc),
+    )
+
+
+# Low-cardinality label columns worth dictionary-encoding (-> pandas category)
+CATEGORY_COLUMNS = {
+    "broad_concept_name",
+    "concept_name",
+    "section_name",
+    "subclass_name",
+    "country_name",
+    "region",
+}
+
+
+def compact_table(table):
+    # Dictionary-encode the repeated label strings and downcast float64
+    # metrics to float32: halves the resident tables and every pickled
+    # cache_data slice, with precision to spare for a visualization
+    columns = []
+    for name, col in zip(table.column_names, table.columns):
+        if name in CATEGORY_COLUMNS:
+            columns.append(pc.dictionary_encode(col.combine_chunks()))
+        elif pa.types.is_float64(col.type):
+            columns.append(pc.cast(col, pa.float32()))
+        elif pa.types.is_int64(col.type):
+            # Count columns stay far below the int32 range
+            columns.append(pc.cast(col, pa.int32()))
+        else:
+            columns.append(col)
+    return pa.table(columns, names=table.column_names)
+
+
+# Local parquet cache: survives Streamlit worker restarts, which blow
+# away the in-memory caches. Freshness matches the cache TTL
+LOCAL_CACHE_DIR = Path(tempfile.gettempdir()) / "country-innovation"
+LOCAL_CACHE_TTL = 600
+
+
+def read_parquet_gcs(pa_gcs, BUCKET_NAME, file_name, columns=None):
+    # Serve from the memory-mapped local copy when it is fresh; on a
+    # miss, read the projected columns from GCS (pre_buffer coalesces
+    # the column-chunk ranges into concurrent fetches) and persist the
+    # projected table locally. The atomic os.replace keeps concurrent
+    # workers from reading a half-written file
+    local_path = LOCAL_CACHE_DIR / file_name
+    if (
+        local_path.exists()
+        and time.time() - local_path.stat().st_mtime < LOCAL_CACHE_TTL
+    ):
+        table = pq.read_table(str(local_path), columns=columns, memory_map=True)
+    else:
+        table = pq.read_table(
+            f"{BUCKET_NAME}/{file_name}",
+            filesystem=pa_gcs,
+            columns=columns,
+            pre_buffer=True,
+        )
+        LOCAL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = local_path.with_suffix(f".{os.getpid()}.tmp")
+        pq.write_table(table, str(tmp_path))
+        os.replace(tmp_path, local_path)
+    return compact_table(table)
+
+
+def gcsfs_to_pandas(fs, BUCKET_NAME, file_name, columns=None):
+    # Kept for CSV inputs, which have no Arrow-native reader path here
     with fs.open(f"{BUCKET_NAME}/{file_name}") as f:
-        if file_name.endswith(".parquet"):
-            df = pd.read_parquet(f)
-        elif file_name.endswith(".csv"):
-            df = pd.read_csv(f)
+        if file_name.endswith(".csv"):
+            df = pd.read_csv(f, usecols=columns)
         else:
             raise ValueError("File format not supported")
     return df
 
 
+# Columns actually referenced by the app, per file
+WORKS_COLUMNS = [
+    "country_code",
+    "broad_concept_name",
+    "concept_name",
+    "works",
+    "works_cited",
+    "citations",
+    "citations_cited",
+    "works_prody_count",
+    "works_cited_prody_count",
+    "citations_prody_count",
+    "citations_cited_prody_count",
+]
+PATENTS_COLUMNS = [
+    "country_code",
+    "section_name",
+    "subclass_code",
+    "subclass_name",
+    "patent_count",
+    "patent_count_prody_count",
+]
+COUNTRY_CODES_COLUMNS = ["country_code", "country_name"]
+COUNTRY_TOTALS_COLUMNS = [
+    "country_code",
+    "country_name",
+    "region",
+    "gdppc",
+    "pop",
+    "patent_count",
+    "patent_count_pc",
+    "patent_count_expy_count",
+    "works",
+    "works_cited",
+    "citations",
+    "citations_cited",
+    "works_pc",
+    "works_cited_pc",
+    "citations_pc",
+    "citations_cited_pc",
+    "works_expy_count",
+    "works_cited_expy_count",
+    "citations_expy_count",
+    "citations_cited_expy_count",
+]
+
+
+# Dispatch tables mapping widget options to column-name suffixes, so
+# the plotted column is resolved by lookup instead of if/elif chains
+CITATION_CONSTRAINT_SUFFIX = {"none": "", "at least 5": "_cited"}
+TRANSFORMATION_SUFFIX = {"none": "", "rca": "_rca"}
+# (suffix, log-scale flag) per scatterplot aggregation method
+SCATTER_AGG_SUFFIX = {
+    "total": ("", True),
+    "per capita": ("_pc", True),
+    "sophistication (expy)": ("_expy_count", False),
+}
+OA_COLOR_SUFFIX = {"broad concept": None, "concept sophistication (prody)": "_prody_count"}
+PAT_COLOR_SUFFIX = {"patent class": None, "subclass sophistication (prody)": "_prody_count"}
+
+
+def lookup_option(table, value, what):
+    # Resolve a widget value against a dispatch table with a real error
+    # (the old `raise "..."` string-raises were TypeErrors at runtime)
+    try:
+        return table[value]
+    except KeyError:
+        raise ValueError(f"Invalid {what}: {value}")
+
+
+# File and column whitelist for each cached table
+TABLE_FILES = {
+    "works": ("country_concept.parquet", WORKS_COLUMNS),
+    "patents": ("country_patents.parquet", PATENTS_COLUMNS),
+    "country_codes": ("country_codes.parquet", COUNTRY_CODES_COLUMNS),
+    "country_totals": ("country_totals.parquet", COUNTRY_TOTALS_COLUMNS),
+}
+
+
+@st.cache_resource(ttl=600)
+def load_table(name):
+    # Canonical data lives here once per server as pyarrow Tables, held
+    # by reference: cache_resource does not pickle on every hit the way
+    # cache_data does for large DataFrames. Callers must treat the
+    # tables as read-only. One cache entry per file, so a TTL expiry or
+    # eviction of one table does not invalidate the other three.
+    file_name, columns = TABLE_FILES[name]
+    table = read_parquet_gcs(
+        prepare_pyarrow_gcs(), "country-innovation", file_name, columns
+    )
+    if name in ("works", "patents"):
+        # Sort the country-keyed tables once so per-country access is a
+        # zero-copy slice of contiguous rows (see country_row_ranges)
+        table = table.sort_by("country_code")
+    return table
+
+
+def load_tables():
+    # Warm all four tables: the files are independent, so cache misses
+    # are fetched concurrently and cold-start wall time is roughly the
+    # slowest file instead of the sum of all four
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = {name: pool.submit(load_table, name) for name in TABLE_FILES}
+        return {name: future.result() for name, future in futures.items()}
+
+
+@st.cache_resource(ttl=600)
+def validate_plot_columns():
+    # Check every column name the dispatch tables can resolve against
+    # the loaded schemas once per TTL, so a schema drift in the bucket
+    # fails loudly at load time instead of deep inside a plot call.
+    # rca columns are derived in-app from the base counts, so only the
+    # base and prody columns need to exist
+    expected = {"works": set(), "patents": set(), "country_totals": set()}
+    for metric in ("works", "citations"):
+        for cit_suffix in CITATION_CONSTRAINT_SUFFIX.values():
+            base = f"{metric}{cit_suffix}"
+            expected["works"].add(base)
+            expected["works"].add(base + "_prody_count")
+            expected["country_totals"].update(
+                base + agg_suffix for agg_suffix, _ in SCATTER_AGG_SUFFIX.values()
+            )
+    expected["patents"].add("patent_count")
+    expected["patents"].add("patent_count_prody_count")
+    expected["country_totals"].update(
+        "patent_count" + agg_suffix for agg_suffix, _ in SCATTER_AGG_SUFFIX.values()
+    )
+    missing = [
+        f"{name}.{col}"
+        for name, cols in expected.items()
+        for col in sorted(cols - set(load_table(name).column_names))
+    ]
+    if missing:
+        raise ValueError(f"Columns missing from parquet schema: {missing}")
+
+
+@st.cache_resource(ttl=600)
+def get_table_pandas(name):
+    # Pandas view of the small reference tables (codes, totals), shared
+    # by reference: cache_resource skips the per-hit hashing/pickling
+    # that cache_data pays, so callers must not mutate the frame.
+    # split_blocks skips the block-consolidation copy during conversion
+    return load_table(name).to_pandas(split_blocks=True)
+
+
+@st.cache_data(ttl=600)
+def country_name_to_code():
+    # O(1) name -> code lookup instead of a boolean-mask scan per rerun
+    cc_df = get_table_pandas("country_codes")
+    return dict(zip(cc_df.country_name, cc_df.country_code))
+
+
+@st.cache_data(ttl=600)
+def country_name_options():
+    # Sorted names for the sidebar selectbox, computed once instead of
+    # a unique() scan on every rerun
+    return tuple(sorted(country_name_to_code()))
+
+
+@st.cache_data(ttl=600)
+def country_totals_scalars():
+    # Per-country headline totals as a dict of scalars, so the three
+    # .loc[...].iloc[0] lookups per rerun become dict indexing
+    ct_df = get_table_pandas("country_totals")
+    return ct_df.set_index("country_code")[
+        ["patent_count", "works", "citations"]
+    ].to_dict("index")
+
+
+@st.cache_resource(ttl=600)
+def country_row_ranges(name):
+    # (start, stop) row range per country in the sorted table, built
+    # once, so country lookup is a dict hit instead of an equality scan
+    codes = load_table(name)["country_code"].to_numpy(zero_copy_only=False)
+    unique_codes, starts = np.unique(codes, return_index=True)
+    stops = np.append(starts[1:], len(codes))
+    return {
+        code: (int(start), int(stop))
+        for code, start, stop in zip(unique_codes, starts, stops)
+    }
+
+
+@st.cache_data(ttl=600)
+def get_country_slice(name, country_code, columns=None, positive_col=None):
+    # Materialize only the selected country's rows as pandas, so each
+    # rerun hashes/pickles a few hundred rows instead of the full table.
+    # With positive_col set, rows where that metric is null or <= 0 are
+    # dropped on the Arrow side before pandas ever allocates them;
+    # columns (a tuple, to stay hashable as a cache key) restricts the
+    # slice to the columns the caller will actually touch
+    tbl = load_table(name)
+    start, stop = country_row_ranges(name).get(country_code, (0, 0))
+    tbl = tbl.slice(start, stop - start)
+    if positive_col is not None:
+        tbl = tbl.filter(pc.greater(tbl[positive_col], 0))
+    if columns is not None:
+        tbl = tbl.select(list(columns))
+    return tbl.to_pandas(split_blocks=True)
+
+
+@st.cache_data(ttl=600)
+def get_world_leaf_shares(name, leaf_col, value_col):
+    # Each leaf's share of the world total in value_col, used to derive
+    # rca in-app so the precomputed *_rca columns never leave the bucket
+    agg = get_global_agg(name, (leaf_col,), value_col)
+    return dict(zip(agg[leaf_col], agg[value_col] / agg[value_col].sum()))
+
+
 @st.cache_data(ttl=600)
-def read_data():
-    # Get GCSFS
-    fs = prepare_gcsfs()
-    # Set GCS bucket name
-    BUCKET_NAME = "country-innovation"
-    # Read OpenAlex data
-    works_all = gcsfs_to_pandas(fs, BUCKET_NAME, "country_concept.parquet")
-    # Read patents data
-    patents = gcsfs_to_pandas(fs, BUCKET_NAME, "country_patents.parquet")
-    # Read country codes
-    country_codes = gcsfs_to_pandas(fs, BUCKET_NAME, "country_codes.parquet")
-    # Read country totals
-    country_totals = gcsfs_to_pandas(fs, BUCKET_NAME, "country_totals.parquet")
-    return works_all, patents, country_codes, country_totals
+def build_treemap_arrays(
+    name, country_code, path_cols, value_col, color_col=None, hover_col=None
+):
+    # Aggregate a country's rows into the ids/labels/parents/values
+    # arrays go.Treemap wants, so plotly express's pandas-heavy path
+    # aggregation is not rebuilt on every rerun. hover_col rides along
+    # as a per-leaf customdata array (e.g. the IPC4 subclass code)
+    parent_col, leaf_col = path_cols
+    # rca is derived from the base count: (country share of the leaf's
+    # count) / (world share of the leaf's count)
+    base_col = value_col.removesuffix("_rca")
+    slice_cols = tuple(path_cols) + (base_col,)
+    if color_col is not None:
+        slice_cols += (color_col,)
+    if hover_col is not None:
+        slice_cols += (hover_col,)
+    df = get_country_slice(
+        name, country_code, columns=slice_cols, positive_col=base_col
+    )
+    if base_col != value_col:
+        world_shares = df[leaf_col].map(get_world_leaf_shares(name, leaf_col, base_col))
+        df[value_col] = (
+            df[base_col] / df[base_col].sum()
+        ) / world_shares.astype("float64")
+    if color_col is not None:
+        # Parent color is the value-weighted mean of its children,
+        # matching what px.treemap computes for continuous color
+        df = df.assign(_weighted_color=df[value_col] * df[color_col])
+        agg_cols = [value_col, "_weighted_color"]
+    else:
+        agg_cols = [value_col]
+    leaf_groups = df.groupby([parent_col, leaf_col], observed=True)
+    leaves = leaf_groups[agg_cols].sum().reset_index()
+    if hover_col is not None:
+        leaves[hover_col] = leaf_groups[hover_col].first().to_numpy()
+    parents = leaves.groupby(parent_col, observed=True)[agg_cols].sum().reset_index()
+    parent_labels = parents[parent_col].astype(str).to_numpy()
+    leaf_parents = leaves[parent_col].astype(str)
+    leaf_labels = leaves[leaf_col].astype(str)
+    # Concatenate ids in pandas: np.char rejects the object-dtype
+    # arrays these string columns produce on NumPy 1.x
+    leaf_ids = (leaf_parents + "/" + leaf_labels).to_numpy()
+    leaf_parents = leaf_parents.to_numpy()
+    leaf_labels = leaf_labels.to_numpy()
+    arrays = {
+        "ids": np.concatenate([parent_labels, leaf_ids]),
+        "labels": np.concatenate([parent_labels, leaf_labels]),
+        "parents": np.concatenate([np.full(len(parents), "", dtype=object), leaf_parents]),
+        "values": np.concatenate([parents[value_col], leaves[value_col]]),
+    }
+    if color_col is not None:
+        arrays["colors"] = np.concatenate(
+            [
+                parents["_weighted_color"] / parents[value_col],
+                leaves["_weighted_color"] / leaves[value_col],
+            ]
+        )
+    if hover_col is not None:
+        arrays["customdata"] = np.concatenate(
+            [
+                np.full(len(parents), "", dtype=object),
+                leaves[hover_col].astype(str).to_numpy(),
+            ]
+        )
+    return arrays
+
+
+@st.cache_data(ttl=600, max_entries=64)
+def build_treemap_figure(
+    name,
+    country_code,
+    path_cols,
+    value_col,
+    color_col=None,
+    color_range=None,
+    color_label=None,
+    hover_col=None,
+):
+    # Render the precomputed hierarchy with a lightweight go.Treemap;
+    # returns None when nothing is left to plot (small country + rca).
+    # Cached per (country, column) combination so revisiting a previous
+    # selection skips figure construction entirely; 64 entries covers
+    # typical sidebar navigation without letting figures pile up
+    import plotly.graph_objects as go
+
+    arrays = build_treemap_arrays(
+        name, country_code, path_cols, value_col, color_col, hover_col
+    )
+    if len(arrays["values"]) == 0:
+        return None
+    marker = None
+    if color_col is not None:
+        marker = dict(
+            colors=arrays["colors"],
+            colorscale="Inferno",
+            cmin=color_range[0],
+            cmax=color_range[1],
+            colorbar=dict(title=color_label),
+        )
+    hover_kwargs = {}
+    if hover_col is not None:
+        # Surface the per-leaf customdata (e.g. IPC4 subclass code) in
+        # the hover, which the default treemap hover does not show
+        hover_kwargs = dict(
+            customdata=arrays["customdata"],
+            hovertemplate=(
+                "<b>%{label}</b><br>%{customdata}<br>%{value}<extra></extra>"
+            ),
+        )
+    fig = go.Figure(
+        go.Treemap(
+            ids=arrays["ids"],
+            labels=arrays["labels"],
+            parents=arrays["parents"],
+            values=arrays["values"],
+            branchvalues="total",
+            marker=marker,
+            **hover_kwargs,
+        )
+    )
+    fig.update_layout(margin=dict(t=50, l=25, r=25, b=25))
+    return fig
+
+
+@st.cache_data(ttl=600)
+def build_scatter_figure(y_col, log_y, y_label, selected_country):
+    # The scatters depend only on these scalars, so cache the built
+    # figure and skip the plotly express work entirely when a rerun is
+    # triggered by treemap-only widgets
+    import plotly.express as px
+
+    country_totals = get_table_pandas("country_totals")
+    # Annotate the selected country via a standalone text array instead
+    # of writing a column into the cached frame
+    text_arr = np.where(
+        country_totals["country_code"].to_numpy() == selected_country,
+        selected_country,
+        "",
+    )
+    fig = px.scatter(
+        country_totals,
+        x="gdppc",
+        y=y_col,
+        color="region",
+        size="pop",
+        log_x=True,
+        log_y=log_y,
+        hover_name="country_name",
+        hover_data=[
+            "gdppc",
+            y_col,
+        ],
+        text=text_arr,
+        labels={
+            "gdppc": "GDP per capita",
+            y_col: y_label,
+        },
+        template="simple_white",
+    )
+    fig.update_layout(margin=dict(t=50, l=25, r=25, b=25), showlegend=False)
+    return fig
+
+
+def session_memo(key, builder, max_entries=8):
+    # Small per-session LRU on top of the global figure cache: the
+    # cache_data LRU is shared across users, so under memory pressure
+    # concurrent viewers evict each other's figures. Each session keeps
+    # its own recently viewed figures so navigating back stays instant
+    cache = st.session_state.setdefault("_figure_memo", {})
+    if key in cache:
+        # Re-insert to refresh recency
+        cache[key] = cache.pop(key)
+        return cache[key]
+    value = builder()
+    cache[key] = value
+    while len(cache) > max_entries:
+        cache.pop(next(iter(cache)))
+    return value
+
+
+@st.cache_data(ttl=600)
+def get_global_agg(name, group_cols, value_col):
+    # Aggregate on the Arrow table (C++ group-by) and only hand the
+    # small aggregated result to pandas, for the Global Treemaps tab
+    tbl = load_table(name)
+    agg = tbl.group_by(list(group_cols)).aggregate([(value_col, "sum")]).to_pandas()
+    return agg.rename(columns={f"{value_col}_sum": value_col})
 
 
 def write_intro():
@@ -79,10 +561,9 @@ write_intro()
 
 # -------------------------#
 # Read data
-fs = prepare_gcsfs()
-# Set GCS bucket name
-BUCKET_NAME = "country-innovation"
-works_all, patents, country_codes, country_totals = read_data()
+load_tables()
+validate_plot_columns()
+country_codes = get_table_pandas("country_codes")
 
 # -------------------------#
 # Set up sidebar - generic
@@ -92,11 +573,9 @@ works_all, patents, country_codes, country_totals = read_data()
 # Country
 selected_country_name = st.sidebar.selectbox(
     label="Country",
-    options=country_codes.country_name.unique(),
+    options=country_name_options(),
 )
-selected_country = country_codes[
-    country_codes.country_name == selected_country_name
-].country_code.values[0]
+selected_country = country_name_to_code()[selected_country_name]
 
 # -------------------------#
 # Set up sidebar - OpenAlex
@@ -185,102 +664,34 @@ publications_prody_color_range = {
 }
 # -------------------------#
 
-# Process parameters
-
-# Filter to selected country
-country_works_count = works_all[works_all.country_code == selected_country]
-country_patents_count = patents[patents.country_code == selected_country]
-
 # -------------------------#
 # Plot scatters
 # -------------------------#
 
-# Scatterplot parameters - publications - citation constraint
-if selected_oa_citation_constraint == "none":
-    scatter_col_oa = selected_oa_metric
-elif selected_oa_citation_constraint == "at least 5":
-    scatter_col_oa = f"{selected_oa_metric}_cited"
-else:
-    raise "Invalid citation constraint"
-
-# Scatterplot parameters - publications - aggregation
-log_oa = True
-if selected_oa_agg_input == "total":
-    scatter_col_oa = scatter_col_oa
-elif selected_oa_agg_input == "per capita":
-    scatter_col_oa = f"{scatter_col_oa}_pc"
-elif selected_oa_agg_input == "sophistication (expy)":
-    scatter_col_oa = f"{scatter_col_oa}_expy_count"
-    log_oa = False
-else:
-    raise "Invalid aggregation method"
-
-# Scatterplot parameters - patents - aggregation
-scatter_col_pat = "patent_count"
-log_pat = True
-if selected_pat_agg_input == "total":
-    scatter_col_pat = scatter_col_pat
-elif selected_pat_agg_input == "per capita":
-    scatter_col_pat = f"{scatter_col_pat}_pc"
-elif selected_pat_agg_input == "sophistication (expy)":
-    scatter_col_pat = f"{scatter_col_pat}_expy_count"
-    log_pat = False
-else:
-    raise "Invalid aggregation method"
-
-
-# Add annotation
-country_totals["selected_country"] = ""
-country_totals.loc[
-    country_totals.country_code == selected_country, "selected_country"
-] = selected_country
+# Scatterplot parameters - publications
+constraint_suffix_oa = lookup_option(
+    CITATION_CONSTRAINT_SUFFIX, selected_oa_citation_constraint, "citation constraint"
+)
+agg_suffix_oa, log_oa = lookup_option(
+    SCATTER_AGG_SUFFIX, selected_oa_agg_input, "aggregation method"
+)
+scatter_col_oa = f"{selected_oa_metric}{constraint_suffix_oa}{agg_suffix_oa}"
 
-# Scatterplot - publications
-scatter_oa = px.scatter(
-    country_totals,
-    x="gdppc",
-    y=scatter_col_oa,
-    color="region",
-    size="pop",
-    log_x=True,
-    log_y=log_oa,
-    hover_name="country_name",
-    hover_data=[
-        "gdppc",
-        scatter_col_oa,
-    ],
-    text="selected_country",
-    labels={
-        "gdppc": "GDP per capita",
-        scatter_col_oa: f"Publications {selected_oa_agg_input}",
-    },
-    template="simple_white",
+# Scatterplot parameters - patents
+agg_suffix_pat, log_pat = lookup_option(
+    SCATTER_AGG_SUFFIX, selected_pat_agg_input, "aggregation method"
 )
-scatter_oa.update_layout(margin=dict(t=50, l=25, r=25, b=25), showlegend=False)
+scatter_col_pat = f"patent_count{agg_suffix_pat}"
 
+# Scatterplot - publications
+scatter_oa = build_scatter_figure(
+    scatter_col_oa, log_oa, f"Publications {selected_oa_agg_input}", selected_country
+)
 
 # Scatterplot - patents
-scatter_pat = px.scatter(
-    country_totals,
-    x="gdppc",
-    y=scatter_col_pat,
-    color="region",
-    size="pop",
-    log_x=True,
-    log_y=log_pat,
-    hover_name="country_name",
-    hover_data=[
-        "gdppc",
-        scatter_col_pat,
-    ],
-    text="selected_country",
-    labels={
-        "gdppc": "GDP per capita",
-        scatter_col_pat: f"Patents {selected_pat_agg_input}",
-    },
-    template="simple_white",
+scatter_pat = build_scatter_figure(
+    scatter_col_pat, log_pat, f"Patents {selected_pat_agg_input}", selected_country
 )
-scatter_pat.update_layout(margin=dict(t=50, l=25, r=25, b=25), showlegend=False)
 
 
 # Plot side by side
@@ -289,26 +700,21 @@ with col1:
     st.markdown(
         "<h3 style='text-align: center;'>Publications</h3>", unsafe_allow_html=True
     )
-    st.plotly_chart(scatter_oa, use_container_width=True)
+    st.plotly_chart(scatter_oa, use_container_width=True, key="scatter-publications")
 
 with col2:
     st.markdown("<h3 style='text-align: center;'>Patents</h3>", unsafe_allow_html=True)
-    st.plotly_chart(scatter_pat, use_container_width=True)
+    st.plotly_chart(scatter_pat, use_container_width=True, key="scatter-patents")
 
 # -------------------------#
 # Treemaps
 # -------------------------#
 
-# Get country total for publications
-country_total_patents_count = country_totals.loc[
-    country_totals.country_code == selected_country, "patent_count"
-].iloc[0]
-country_total_works_count = country_totals.loc[
-    country_totals.country_code == selected_country, "works"
-].iloc[0]
-country_total_citations_count = country_totals.loc[
-    country_totals.country_code == selected_country, "citations"
-].iloc[0]
+# Get country totals for publications and patents
+selected_country_totals = country_totals_scalars()[selected_country]
+country_total_patents_count = selected_country_totals["patent_count"]
+country_total_works_count = selected_country_totals["works"]
+country_total_citations_count = selected_country_totals["citations"]
 
 # -------------------------#
 # Plot OpenAlex treemap
@@ -322,29 +728,20 @@ st.markdown(f"Total citations: {country_total_citations_count:,.0f}")
 # Prepare plotting column - OpenAlex
 
 # Column to plot - citation constraint
-if selected_oa_citation_constraint == "none":
-    plot_col_oa_constraint = f"{selected_oa_metric}"
-elif selected_oa_citation_constraint == "at least 5":
-    plot_col_oa_constraint = f"{selected_oa_metric}_cited"
-else:
-    raise ValueError("Invalid citation constraint")
-
+plot_col_oa_constraint = f"{selected_oa_metric}{constraint_suffix_oa}"
 
 # Column to plot - rca or not
-if selected_oa_transformations == "none":
-    plot_col_oa = plot_col_oa_constraint
-elif selected_oa_transformations == "rca":
-    plot_col_oa = plot_col_oa_constraint + "_rca"
-else:
-    raise ValueError("Invalid transformation")
+plot_col_oa = plot_col_oa_constraint + lookup_option(
+    TRANSFORMATION_SUFFIX, selected_oa_transformations, "transformation"
+)
 
 # Column to plot - color
-if selected_oa_color_parameter == "concept sophistication (prody)":
-    color_col_oa = f"{plot_col_oa_constraint}_prody_count"
-elif selected_oa_color_parameter == "broad concept":
-    color_col_oa = None
-else:
-    raise ValueError("Invalid color parameter")
+color_suffix_oa = lookup_option(
+    OA_COLOR_SUFFIX, selected_oa_color_parameter, "color parameter"
+)
+color_col_oa = (
+    None if color_suffix_oa is None else plot_col_oa_constraint + color_suffix_oa
+)
 
 # -------------------------#
 # Plot treemaps
@@ -354,39 +751,30 @@ tabs = st.tabs(["Country Treemaps", "Global Treemaps"])
 
 with tabs[0]:
     # -------------------------#
-    # if (
-    #     selected_oa_transformations == "none"
-    #     and selected_oa_color_parameter == "broad concept"
-    # ):
-    #     fig_oa_path = ["broad_concept_name", "concept_name"]
-    # else:
-    #     fig_oa_path = ["concept_name"]
-    fig_oa_path = ["broad_concept_name", "concept_name"]
+    fig_oa_path = ("broad_concept_name", "concept_name")
 
     if selected_oa_color_parameter == "concept sophistication (prody)":
-        fig_oa_color = color_col_oa
-        fig_oa_color_continous_scale = px.colors.sequential.Inferno
-        fig_oa_range_color = publications_prody_color_range[color_col_oa]
-        fig_oa_labels_dict = {color_col_oa: "PRODY"}
+        build_oa = lambda: build_treemap_figure(
+            "works",
+            selected_country,
+            fig_oa_path,
+            plot_col_oa,
+            color_col=color_col_oa,
+            color_range=publications_prody_color_range[color_col_oa],
+            color_label="PRODY",
+        )
     else:
-        fig_oa_color = None
-        fig_oa_color_continous_scale = None
-        fig_oa_range_color = None
-        fig_oa_labels_dict = None
-
-    fig_oa = px.treemap(
-        country_works_count[country_works_count[plot_col_oa] > 0],
-        path=fig_oa_path,
-        values=plot_col_oa,
-        hover_name="concept_name",
-        color=fig_oa_color,
-        color_continuous_scale=fig_oa_color_continous_scale,
-        range_color=fig_oa_range_color,
-        labels=fig_oa_labels_dict,
+        build_oa = lambda: build_treemap_figure(
+            "works", selected_country, fig_oa_path, plot_col_oa
+        )
+    fig_oa = session_memo(
+        ("treemap", "works", selected_country, plot_col_oa, color_col_oa), build_oa
     )
-    fig_oa.update_layout(margin=dict(t=50, l=25, r=25, b=25))
 
-    st.plotly_chart(fig_oa, use_container_width=True)
+    if fig_oa is None:
+        st.info("No publications data for the selected filters")
+    else:
+        st.plotly_chart(fig_oa, use_container_width=True, key="treemap-publications")
 
     # -------------------------#
     # Plot patents treemap
@@ -400,66 +788,57 @@ with tabs[0]:
 
     # Column to plot - rca or not
     plot_col_pat_raw = "patent_count"
-    if selected_pat_transformations == "none":
-        plot_col_pat = plot_col_pat_raw
-    elif selected_pat_transformations == "rca":
-        plot_col_pat = plot_col_pat_raw + "_rca"
-    else:
-        raise ValueError("Invalid transformation")
+    plot_col_pat = plot_col_pat_raw + lookup_option(
+        TRANSFORMATION_SUFFIX, selected_pat_transformations, "transformation"
+    )
 
     # Column to plot - color
-    if selected_pat_color_parameter == "subclass sophistication (prody)":
-        color_col_pat = f"{plot_col_pat_raw}_prody_count"
-    elif selected_pat_color_parameter == "patent class":
-        color_col_pat = None
-    else:
-        raise ValueError("Invalid color parameter")
+    color_suffix_pat = lookup_option(
+        PAT_COLOR_SUFFIX, selected_pat_color_parameter, "color parameter"
+    )
+    color_col_pat = (
+        None if color_suffix_pat is None else plot_col_pat_raw + color_suffix_pat
+    )
 
     # -------------------------#
     # Plot treemap
-    # if (
-    #     selected_pat_transformations == "none"
-    #     and selected_pat_color_parameter == "patent class"
-    # ):
-    #     fig_pat_path = ["section_name", "subclass_name"]
-    # else:
-    #     fig_pat_path = ["subclass_name"]
-    fig_pat_path = ["section_name", "subclass_name"]
+    fig_pat_path = ("section_name", "subclass_name")
 
     if selected_pat_color_parameter == "subclass sophistication (prody)":
-        fig_pat_color = color_col_pat
-        fig_pat_color_continous_scale = px.colors.sequential.Inferno
-        fig_pat_range_color = patents_prody_color_range[color_col_pat]
-        fig_pat_labels_dict = {color_col_pat: "PRODY"}
+        build_pat = lambda: build_treemap_figure(
+            "patents",
+            selected_country,
+            fig_pat_path,
+            plot_col_pat,
+            color_col=color_col_pat,
+            color_range=patents_prody_color_range[color_col_pat],
+            color_label="PRODY",
+            hover_col="subclass_code",
+        )
     else:
-        fig_pat_color = None
-        fig_pat_color_continous_scale = None
-        fig_pat_range_color = None
-        fig_pat_labels_dict = None
-
-    fig_pat = px.treemap(
-        country_patents_count[country_patents_count[plot_col_pat] > 0],
-        path=fig_pat_path,
-        values=plot_col_pat,
-        hover_name="subclass_name",
-        hover_data=[
-            "subclass_code",
-            "section_name",
-        ],
-        color=fig_pat_color,
-        color_continuous_scale=fig_pat_color_continous_scale,
-        range_color=fig_pat_range_color,
-        labels=fig_pat_labels_dict,
+        build_pat = lambda: build_treemap_figure(
+            "patents",
+            selected_country,
+            fig_pat_path,
+            plot_col_pat,
+            hover_col="subclass_code",
+        )
+    fig_pat = session_memo(
+        ("treemap", "patents", selected_country, plot_col_pat, color_col_pat), build_pat
     )
 
-    fig_pat.update_layout(margin=dict(t=50, l=25, r=25, b=25))
-    st.plotly_chart(fig_pat, use_container_width=True)
+    if fig_pat is None:
+        st.info("No patents data for the selected filters")
+    else:
+        st.plotly_chart(fig_pat, use_container_width=True, key="treemap-patents")
 
 with tabs[1]:
+    import plotly.express as px
+
     # Publications for the world, split by country
     st.write("### Total Publications by Country")
-    global_publications = (
-        works_all.groupby("country_code")[plot_col_oa_constraint].sum().reset_index()
+    global_publications = get_global_agg(
+        "works", ("country_code",), plot_col_oa_constraint
     )
     global_publications = global_publications.merge(country_codes, on="country_code")
 
@@ -472,11 +851,11 @@ with tabs[1]:
         path=["country_name"],
         values=plot_col_oa_constraint,
     )
-    st.plotly_chart(fig_global_pub, use_container_width=True)
+    st.plotly_chart(fig_global_pub, use_container_width=True, key="global-publications")
 
     # Patents for the world, split by country
     st.write("### Total Patents by Country")
-    global_patents = patents.groupby("country_code")["patent_count"].sum().reset_index()
+    global_patents = get_global_agg("patents", ("country_code",), "patent_count")
     global_patents = global_patents.merge(country_codes, on="country_code")
 
     st.markdown(f"Total patents: {global_patents['patent_count'].sum():,.0f}")
@@ -486,16 +865,12 @@ with tabs[1]:
         path=["country_name"],
         values="patent_count",
     )
-    st.plotly_chart(fig_global_pat, use_container_width=True)
+    st.plotly_chart(fig_global_pat, use_container_width=True, key="global-patents")
 
     # Publications for the world, split by IPC4 subclass
     st.write("### World Total Publications by Scientific Concept")
-    global_pub_concept = (
-        works_all.groupby(["broad_concept_name", "concept_name"])[
-            plot_col_oa_constraint
-        ]
-        .sum()
-        .reset_index()
+    global_pub_concept = get_global_agg(
+        "works", ("broad_concept_name", "concept_name"), plot_col_oa_constraint
     )
 
     fig_global_pub_concept = px.treemap(
@@ -504,16 +879,12 @@ with tabs[1]:
         values=plot_col_oa_constraint,
         hover_name="concept_name",
     )
-    st.plotly_chart(fig_global_pub_concept, use_container_width=True)
+    st.plotly_chart(fig_global_pub_concept, use_container_width=True, key="global-publications-concept")
 
     # Patents for the world, split by IPC4 subclass
     st.write("### World Total Patents by IPC4 Subclass")
-    global_pat_subclass = (
-        patents.groupby(["subclass_code", "subclass_name", "section_name"])[
-            "patent_count"
-        ]
-        .sum()
-        .reset_index()
+    global_pat_subclass = get_global_agg(
+        "patents", ("subclass_code", "subclass_name", "section_name"), "patent_count"
     )
 
     fig_global_pat_subclass = px.treemap(
@@ -523,7 +894,7 @@ with tabs[1]:
         hover_name="subclass_name",
         hover_data=["subclass_code", "section_name"],
     )
-    st.plotly_chart(fig_global_pat_subclass, use_container_width=True)
+    st.plotly_chart(fig_global_pat_subclass, use_container_width=True, key="global-patents-subclass")
 
 
 # -------------------------#
@@ -0,0 +1,107 @@
+"""
+Offline helpers for preparing the GCS data layout used by the app.
+
+Not imported by the Streamlit app. Run from an environment with default
+GCP credentials that can write to the bucket:
+
+    python preprocess_gcs_data.py
+
+Author: Shreyas Gadgin Matha
+"""
+
+import pyarrow.dataset as ds
+import pyarrow.fs
+import pyarrow.parquet as pq
+
+BUCKET_NAME = "country-innovation"
+
+# Country-keyed files worth repartitioning
+COUNTRY_KEYED_FILES = [
+    ("country_concept.parquet", "country_concept"),
+    ("country_patents.parquet", "country_patents"),
+]
+
+
+# Treemap-ready aggregation per country-keyed file: the hierarchy
+# levels, the count columns to sum, and the prody color columns (one
+# value per leaf, aggregated with mean)
+TREEMAP_SPECS = {
+    "country_concept.parquet": {
+        "dataset_dir": "treemap_cache/country_concept",
+        "path_cols": ["broad_concept_name", "concept_name"],
+        "sum_cols": [
+            "works",
+            "works_cited",
+            "citations",
+            "citations_cited",
+            "works_rca",
+            "works_cited_rca",
+            "citations_rca",
+            "citations_cited_rca",
+        ],
+        "mean_cols": [
+            "works_prody_count",
+            "works_cited_prody_count",
+            "citations_prody_count",
+            "citations_cited_prody_count",
+        ],
+    },
+    "country_patents.parquet": {
+        "dataset_dir": "treemap_cache/country_patents",
+        "path_cols": ["section_name", "subclass_name"],
+        "sum_cols": ["patent_count", "patent_count_rca"],
+        "mean_cols": ["patent_count_prody_count"],
+    },
+}
+
+
+def write_treemap_cache(pa_gcs=None):
+    # Pre-aggregate the treemap hierarchies per country so consumers
+    # can read a few KB per country instead of filtering and grouping
+    # the full file at query time
+    if pa_gcs is None:
+        pa_gcs = pyarrow.fs.GcsFileSystem()
+    for file_name, spec in TREEMAP_SPECS.items():
+        table = pq.read_table(f"{BUCKET_NAME}/{file_name}", filesystem=pa_gcs)
+        group_cols = ["country_code"] + spec["path_cols"]
+        agg = table.group_by(group_cols).aggregate(
+            [(c, "sum") for c in spec["sum_cols"]]
+            + [(c, "mean") for c in spec["mean_cols"]]
+        )
+        agg = agg.rename_columns(
+            [c.removesuffix("_sum").removesuffix("_mean") for c in agg.column_names]
+        )
+        ds.write_dataset(
+            agg,
+            f"{BUCKET_NAME}/{spec['dataset_dir']}",
+            filesystem=pa_gcs,
+            format="parquet",
+            partitioning=["country_code"],
+            partitioning_flavor="hive",
+            existing_data_behavior="delete_matching",
+        )
+
+
+def repartition_by_country(pa_gcs=None):
+    # Rewrite the country-keyed parquet files as Hive-partitioned
+    # datasets (country_code=XX/part.parquet) so consumers that only
+    # need one country's rows can read a single partition with
+    # predicate pushdown instead of the whole file
+    if pa_gcs is None:
+        pa_gcs = pyarrow.fs.GcsFileSystem()
+    for file_name, dataset_dir in COUNTRY_KEYED_FILES:
+        table = pq.read_table(f"{BUCKET_NAME}/{file_name}", filesystem=pa_gcs)
+        ds.write_dataset(
+            table,
+            f"{BUCKET_NAME}/{dataset_dir}",
+            filesystem=pa_gcs,
+            format="parquet",
+            partitioning=["country_code"],
+            partitioning_flavor="hive",
+            existing_data_behavior="delete_matching",
+        )
+
+
+if __name__ == "__main__":
+    repartition_by_country()
+    write_treemap_cache()